@@ -39,30 +39,27 @@ import pickle
 # Date   : 08.09.2024
 
 
+import io
 import os
 import sys
 import shutil
+import tempfile
 import subprocess
 from glob import glob
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import rtoml
 import numpy as np
-from natsort import natsorted
+import pandas as pd
 
 # ACCESS PARAMETERS START
 
 # Unpickle `parameters` from this script's first command-line argument and set
 # `access_id` to a unique simulation ID
 
-import coexist
-
-def create_parameters(**kw):
-    variables = list(kw.keys())
-    minimums = [kw[v][0] for v in variables]
-    maximums = [kw[v][1] for v in variables]
-    values = [(kw[v][2] if (len(kw[v]) == 3) else ((kw[v][0] + kw[v][1]) / 2)) for v in variables]
-    return coexist.create_parameters(variables, minimums, maximums, values)
-with open(sys.argv[1], 'rb') as f:
+with open(sys.argv[1], 'rb', buffering=1 << 20) as f:
     parameters = pickle.load(f)
 access_id = 'JM-BaseCase'
 
@@ -85,6 +82,26 @@ def system(cmd, cwd=None):
     subprocess.run(cmd, check=True, cwd=cwd)
 
 
+def system_parallel(cmd, cwds):
+    # Run the same command concurrently in independent directories
+    print("Running command:", cmd, "in", ", ".join(cwds), flush=True)
+    processes = []
+    try:
+        for cwd in cwds:
+            processes.append(subprocess.Popen(cmd, cwd=cwd))
+    except Exception:
+        # Do not leave already started processes running on a failed trial
+        for process in processes:
+            process.terminate()
+            process.wait()
+        raise
+
+    returncodes = [process.wait() for process in processes]
+    for returncode in returncodes:
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+
 def system_timeout(cmd, timeout, cwd=None):
     print(f"Running command with timeout {timeout / 3600} h:", cmd, flush=True)
 
@@ -109,104 +126,166 @@ def system_timeout(cmd, timeout, cwd=None):
     return True
 
 
+def remove(path):
+    # Same as `rm -rf`, without forking a process
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def remove_parallel(paths, workers=16):
+    # Overlap the filesystem latency of removing many directories
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(remove, paths))
+
+
+def copy_clone(src, dst):
+    # Copy file data inside the kernel; reflinks on XFS / Btrfs and copies
+    # server-side on NFS 4.2, falling back to a regular copy if unsupported
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                # Template files do not shrink; a short copy means no fast path
+                if copied == 0:
+                    raise OSError("copy_file_range stopped before the end of the file")
+                remaining -= copied
+    except (AttributeError, OSError):
+        return shutil.copy2(src, dst)
+
+    shutil.copystat(src, dst)
+    return dst
+
+
+def write_atomic(path, text, mode_src):
+    # Write to a sibling temporary file with the permissions of `mode_src`,
+    # then rename it over `path`, so the file is never seen half-written on
+    # the shared filesystem
+    f = tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False)
+    try:
+        with f:
+            f.write(text)
+        shutil.copymode(mode_src, f.name)
+        os.replace(f.name, path)
+    except Exception:
+        os.unlink(f.name)
+        raise
+
+
+@contextmanager
+def patch_toml(src, dst):
+    # Yield the settings parsed from `src`, then write them to `dst` on exit
+    settings = rtoml.loads(src.read_text())
+    yield settings
+    write_atomic(dst, rtoml.dumps(settings), src)
+
+
 def create_case(parameters, trial_path):
 
-    # Copy template into trial directory
-    shutil.copytree("Template", trial_path, dirs_exist_ok=True)
+    # Convert parameter values to Python floats once, rather than per lookup
+    values = dict(zip(parameters.index, parameters["value"].astype(float).tolist()))
+
+    # Settings files patched below, as (template, trial) paths
+    template, trial = Path("Template"), Path(trial_path)
+    settings_paths = {
+        phase: (template / phase / "settings.toml", trial / phase / "settings.toml")
+        for phase in ["phase-1-geometry-vessel", "phase-2-geometry-impeller", "phase-4-mesh"]
+    }
+
+    # Copy template into trial directory; the settings patched below are read
+    # from the template and written once, instead of being copied then rewritten
+    def ignore(src, names):
+        # Skip the settings files written by `patch_toml` below
+        return ["settings.toml"] if os.path.relpath(src, template) in settings_paths else []
+
+    shutil.copytree(template, trial, dirs_exist_ok=True, ignore=ignore, copy_function=copy_clone)
 
     # Compute vessel sizes, placements, impeller sizes, placements
     vessel_height = 2000
     vessel_base_clearance = 600
     vessel_diameter = 2000
 
-    bottom_clearance = float(parameters["value"]["bottom_clearance"])
+    bottom_clearance = values["bottom_clearance"]
     vessel_height0 = vessel_base_clearance - vessel_height * bottom_clearance
 
-    xplace = float(parameters["value"]["xplace"])
+    xplace = values["xplace"]
     vessel_xtranslate = -vessel_diameter / 2 * xplace
 
-    yplace = float(parameters["value"]["yplace"])
+    yplace = values["yplace"]
     vessel_ytranslate = -vessel_diameter / 2 * yplace
 
-    impeller_height_ratio = float(parameters["value"]["impeller/height_ratio"])
+    impeller_height_ratio = values["impeller/height_ratio"]
     impeller_height = vessel_height * (1 - bottom_clearance) * impeller_height_ratio
 
     max_translate = max(abs(xplace), abs(yplace))
-    impeller_diameter_ratio = float(parameters["value"]["impeller/diameter_ratio"])
+    impeller_diameter_ratio = values["impeller/diameter_ratio"]
     impeller_diameter = vessel_diameter * (1 - max_translate) * impeller_diameter_ratio
 
     # Update vessel settings to optimise
-    with open(f"{trial_path}/phase-1-geometry-vessel/settings.toml") as f:
-        settings = rtoml.load(f)
-
-    settings["height0"] = vessel_height0
-    settings["xtranslate"] = vessel_xtranslate
-    settings["ytranslate"] = vessel_ytranslate
-
-    with open(f"{trial_path}/phase-1-geometry-vessel/settings.toml", "w") as f:
-        rtoml.dump(settings, f)
+    with patch_toml(*settings_paths["phase-1-geometry-vessel"]) as settings:
+        settings["height0"] = vessel_height0
+        settings["xtranslate"] = vessel_xtranslate
+        settings["ytranslate"] = vessel_ytranslate
 
     # Update impeller settings to optimise
-    with open(f"{trial_path}/phase-2-geometry-impeller/settings.toml") as f:
-        settings = rtoml.load(f)
-
-    settings["height"] = impeller_height
-    settings["diameter"] = impeller_diameter
-
-    settings["Blades"][0]["place_rel"] = float(parameters["value"]["impeller/0/place_rel"])
-    settings["Blades"][0]["xlen_rel"] = float(parameters["value"]["impeller/0/xlen_rel"])
-    settings["Blades"][0]["ylen_rel"] = float(parameters["value"]["impeller/0/ylen_rel"])
+    with patch_toml(*settings_paths["phase-2-geometry-impeller"]) as settings:
+        settings["height"] = impeller_height
+        settings["diameter"] = impeller_diameter
 
-    settings["Blades"][0]["joint_place"] = float(parameters["value"]["impeller/0/joint_place"])
-    settings["Blades"][0]["joint_angle"] = float(parameters["value"]["impeller/0/joint_angle"])
+        settings["Blades"][0].update({
+            "place_rel": values["impeller/0/place_rel"],
+            "xlen_rel": values["impeller/0/xlen_rel"],
+            "ylen_rel": values["impeller/0/ylen_rel"],
 
-    settings["Blades"][0]["lean_place"] = float(parameters["value"]["impeller/0/lean_place"])
-    settings["Blades"][0]["lean_angle"] = float(parameters["value"]["impeller/0/lean_angle"])
+            "joint_place": values["impeller/0/joint_place"],
+            "joint_angle": values["impeller/0/joint_angle"],
 
-    settings["Blades"][0]["turn_place"] = float(parameters["value"]["impeller/0/turn_place"])
-    settings["Blades"][0]["turn_angle"] = float(parameters["value"]["impeller/0/turn_angle"])
+            "lean_place": values["impeller/0/lean_place"],
+            "lean_angle": values["impeller/0/lean_angle"],
 
-    settings["Blades"][0]["twist"] = float(parameters["value"]["impeller/0/twist"])
-    settings["Blades"][0]["helix"] = float(parameters["value"]["impeller/0/helix"])
-    settings["Blades"][0]["curl"] = float(parameters["value"]["impeller/0/curl"])
+            "turn_place": values["impeller/0/turn_place"],
+            "turn_angle": values["impeller/0/turn_angle"],
 
-    settings["Blades"][0]["around_number"] = round(parameters["value"]["impeller/0/around_number"])
-    settings["Blades"][0]["repeat_number"] = round(parameters["value"]["impeller/0/repeat_number"])
-    settings["Blades"][0]["repeat_heights_equal"] = float(parameters["value"]["impeller/0/repeat_heights_equal"])
-    settings["Blades"][0]["repeat_angles_bias"] = float(parameters["value"]["impeller/0/repeat_angles_bias"])
+            "twist": values["impeller/0/twist"],
+            "helix": values["impeller/0/helix"],
+            "curl": values["impeller/0/curl"],
 
-    settings["FidgetSurface"][0]["alpha1"] = float(parameters["value"]["impeller/fidgetsurface/0/alpha1"])
-    settings["FidgetSurface"][0]["beta1"] = float(parameters["value"]["impeller/fidgetsurface/0/beta1"])
+            "around_number": round(values["impeller/0/around_number"]),
+            "repeat_number": round(values["impeller/0/repeat_number"]),
+            "repeat_heights_equal": values["impeller/0/repeat_heights_equal"],
+            "repeat_angles_bias": values["impeller/0/repeat_angles_bias"],
+        })
 
-    with open(f"{trial_path}/phase-2-geometry-impeller/settings.toml", "w") as f:
-        rtoml.dump(settings, f)
+        settings["FidgetSurface"][0].update({
+            "alpha1": values["impeller/fidgetsurface/0/alpha1"],
+            "beta1": values["impeller/fidgetsurface/0/beta1"],
+        })
 
     # Update meshing settings based on impeller settings
-    with open(f"{trial_path}/phase-4-mesh/settings.toml") as f:
-        settings = rtoml.load(f)
+    with patch_toml(*settings_paths["phase-4-mesh"]) as settings:
+        # Allow 50 mm around the impeller for rotation cylinder
+        rotation_height0 = -50e-3
+        rotation_height1 = impeller_height / 1000 + 50e-3
+        rotation_radius = impeller_diameter / 1000 / 2 + 50e-3
 
-    # Allow 50 mm around the impeller for rotation cylinder
-    rotation_height0 = -50e-3
-    rotation_height1 = impeller_height / 1000 + 50e-3
-    rotation_radius = impeller_diameter / 1000 / 2 + 50e-3
+        settings["RotationVolume"]["height0"] = rotation_height0
+        settings["RotationVolume"]["height1"] = rotation_height1
+        settings["RotationVolume"]["radius"] = rotation_radius
 
-    settings["RotationVolume"]["height0"] = rotation_height0
-    settings["RotationVolume"]["height1"] = rotation_height1
-    settings["RotationVolume"]["radius"] = rotation_radius
-
-    # Keep the same mesh size as for the JM case, where for a rotation radius of 0.5, we had xscale = 0.5
-    settings["Mesh"]["xscale"] = 0.5 * 0.5 / rotation_radius
-    settings["Mesh"]["yscale"] = 0.5 * 0.5 / rotation_radius
-    settings["Mesh"]["zscale"] = 0.5 * 0.5 / rotation_radius
-
-    with open(f"{trial_path}/phase-4-mesh/settings.toml", "w") as f:
-        rtoml.dump(settings, f)
+        # Keep the same mesh size as for the JM case, where for a rotation radius of 0.5, we had xscale = 0.5
+        settings["Mesh"]["xscale"] = 0.5 * 0.5 / rotation_radius
+        settings["Mesh"]["yscale"] = 0.5 * 0.5 / rotation_radius
+        settings["Mesh"]["zscale"] = 0.5 * 0.5 / rotation_radius
 
 
 def mesh_case(case_path):
-    # Create CAD geometry
-    system([sys.executable, "script.py"], cwd=f"{case_path}/phase-1-geometry-vessel")
-    system([sys.executable, "script.py"], cwd=f"{case_path}/phase-2-geometry-impeller")
+    # Create CAD geometry; the vessel and impeller are independent
+    system_parallel([sys.executable, "script.py"], [
+        f"{case_path}/phase-1-geometry-vessel",
+        f"{case_path}/phase-2-geometry-impeller",
+    ])
 
     # Mesh; sometimes SHM hangs, so we use a timeout
     timeout = 50 * 60
@@ -215,7 +294,7 @@ def mesh_case(case_path):
         raise RuntimeError("Meshing timed out")
 
     # Remove phase 2 decomposed mesh, as only the reconstructed one will be used
-    system(["rm", "-rf"] + glob(f"{case_path}/phase-2-mesh/case/processor*"))
+    remove_parallel(glob(f"{case_path}/phase-2-mesh/case/processor*"))
 
 
 def run_case(case_path):
@@ -224,8 +303,64 @@ def run_case(case_path):
     system_timeout([sys.executable, "script.py"], timeout, cwd=f"{case_path}/phase-5-cfd")
 
     # Remove phase 4 and 5 reconstructed meshes, as they are available decomposed in phase 5
-    system(["rm", "-rf", "constant/polyMesh"], cwd=f"{case_path}/phase-4-mesh/case")
-    system(["rm", "-rf", "constant/polyMesh"], cwd=f"{case_path}/phase-5-cfd/case")
+    remove(f"{case_path}/phase-4-mesh/case/constant/polyMesh")
+    remove(f"{case_path}/phase-5-cfd/case/constant/polyMesh")
+
+
+def latest_time_dir(path):
+    # OpenFOAM time directories are named by their start time
+    return max((e.name for e in os.scandir(path) if e.is_dir()), key=float)
+
+
+def last_time(path, nbytes=4096):
+    # Final simulated time, from the last line of the file only
+    with open(path, "rb") as f:
+        f.seek(max(0, os.path.getsize(path) - nbytes))
+        lines = f.read().rstrip().splitlines()
+
+    # Skip blank and header lines; a file with no data never got going
+    for line in reversed(lines):
+        if line.strip() and not line.lstrip().startswith(b"#"):
+            return float(line.split()[0])
+    raise RuntimeError("Simulation did not run for 20 seconds")
+
+
+def read_tail(path, window=1, nbytes=128 * 1024):
+    # These files grow with simulated time, but only the last `window` seconds
+    # are needed; parse the end of the file, doubling the bytes read until the
+    # window is covered
+    size = os.path.getsize(path)
+    while True:
+        start = max(0, size - nbytes)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # Let the kernel read ahead the whole range at once; these files
+            # usually sit on networked storage
+            os.posix_fadvise(fd, start, size - start, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, start, size - start, os.POSIX_FADV_WILLNEED)
+            buf = os.pread(fd, size - start, start)
+        finally:
+            os.close(fd)
+
+        # Drop the first, possibly partial, line; header lines are comments
+        if start > 0:
+            buf = buf[buf.find(b"\n") + 1:]
+
+        data = pd.read_csv(
+            io.BytesIO(buf), sep=r"\s+", header=None, usecols=[0, 1], comment="#",
+            dtype=np.float64, engine="c",
+        ).to_numpy()
+
+        if start == 0 or data[0, 0] <= data[-1, 0] - window:
+            return data
+        nbytes *= 2
+
+
+def window_mean(data, window=1):
+    # Times are sorted, so the window start is found by binary search instead
+    # of building a boolean mask and a fancy-indexed copy
+    start = np.searchsorted(data[:, 0], data[-1, 0] - window, side="right")
+    return data[start:, 1].mean()
 
 
 create_case(parameters, trial_path)
@@ -234,17 +369,26 @@ run_case(trial_path)
 
 
 # Extract results from last second
-cov_dirs = natsorted(os.listdir(f"{trial_path}/phase-5-cfd/case/postProcessing/volFieldValue1.CoV/"))
-latest_cov_path = f"{trial_path}/phase-5-cfd/case/postProcessing/volFieldValue1.CoV/{cov_dirs[-1]}/volFieldValue.dat"
-cov_data = np.loadtxt(latest_cov_path, skiprows=4)
-time_selection = cov_data[:, 0] > cov_data[-1, 0] - 1
-epsilon_cov = cov_data[time_selection, 1].mean()
+cov_dir = latest_time_dir(f"{trial_path}/phase-5-cfd/case/postProcessing/volFieldValue1.CoV/")
+latest_cov_path = f"{trial_path}/phase-5-cfd/case/postProcessing/volFieldValue1.CoV/{cov_dir}/volFieldValue.dat"
+
+avg_dir = latest_time_dir(f"{trial_path}/phase-5-cfd/case/postProcessing/volFieldValue1.volAverage/")
+latest_avg_path = f"{trial_path}/phase-5-cfd/case/postProcessing/volFieldValue1.volAverage/{avg_dir}/volFieldValue.dat"
 
-avg_dirs = natsorted(os.listdir(f"{trial_path}/phase-5-cfd/case/postProcessing/volFieldValue1.volAverage/"))
-latest_avg_path = f"{trial_path}/phase-5-cfd/case/postProcessing/volFieldValue1.volAverage/{avg_dirs[-1]}/volFieldValue.dat"
-avg_data = np.loadtxt(latest_avg_path, skiprows=4)
-time_selection = avg_data[:, 0] > avg_data[-1, 0] - 1
-epsilon_avg = avg_data[time_selection, 1].mean()
+# Only consider cases that ran for at least 20 seconds; check before parsing
+final_time = last_time(latest_avg_path)
+if final_time < 20:
+    raise RuntimeError("Simulation did not run for 20 seconds")
+
+# The two files are independent; overlap their reads on networked storage
+with ThreadPoolExecutor(2) as executor:
+    cov_future = executor.submit(read_tail, latest_cov_path)
+    avg_future = executor.submit(read_tail, latest_avg_path)
+    cov_data = cov_future.result()
+    avg_data = avg_future.result()
+
+epsilon_cov = window_mean(cov_data)
+epsilon_avg = window_mean(avg_data)
 
 
 # Print results
@@ -252,12 +396,6 @@ print("Epsilon average:", epsilon_avg)
 print("Epsilon CoV:", epsilon_cov)
 
 
-# Only consider cases that ran for at least 20 seconds
-final_time = avg_data[-1, 0]
-if final_time < 20:
-        raise RuntimeError("Simulation did not run for 20 seconds")
-
-
 # Cap epsilon CoV at 0.5; below this value, it is not important
 epsilon_cov = max(epsilon_cov, 0.5)
 
@@ -269,11 +407,11 @@ error = [-epsilon_avg, 1 / epsilon_cov]
 
 
 # Save the user-defined `error` and `extra` variables to disk.
-with open(sys.argv[2], "wb") as f:
-    pickle.dump(error, f)
+with open(sys.argv[2], "wb", buffering=1 << 20) as f:
+    pickle.dump(error, f, protocol=pickle.HIGHEST_PROTOCOL)
 
 if "extra" in locals() or "extra" in globals():
     path = os.path.split(sys.argv[2])
     path = os.path.join(path[0], path[1].replace("result", "extra"))
-    with open(path, "wb") as f:
-        pickle.dump(extra, f)
+    with open(path, "wb", buffering=1 << 20) as f:
+        pickle.dump(extra, f, protocol=pickle.HIGHEST_PROTOCOL)